@@ -1,8 +1,12 @@
 # app.py
+import io
 import os
+import re
+import numpy as np
 import pandas as pd
 import streamlit as st
 import plotly.express as px
+import pyarrow as pa
 from gspread.exceptions import APIError
 import hashlib
 import time
@@ -12,7 +16,7 @@ import gspread
 from google.oauth2.service_account import Credentials
 
 # Backend (merchant_key + regex)
-from preprocessing import process_and_classify
+from preprocessing import compile_config, process_and_classify
 
 
 # =========================
@@ -26,21 +30,93 @@ st.title("Classificador de Gastos")
 GOOGLE_SHEET_ID = st.secrets.get("GOOGLE_SHEET_ID", "")
 DB_SHEET_TAB = st.secrets.get("DB_SHEET_TAB", "db")
 CONFIG_SHEET_TAB = st.secrets.get("CONFIG_SHEET_TAB", "config")
+HEADER_CACHE_TTL = 300  # 5 min: header/worksheet do Sheets reaproveitados entre salvamentos
+# caches de extrato (dados financeiros) são do processo, compartilhados entre sessões:
+# guarda só poucos e por pouco tempo, o suficiente para os reruns
+CSV_CACHE_TTL = 600  # 10 min
+CSV_CACHE_MAX_ENTRIES = 8
 
 # =========================
-# UTIL: CSV DOWNLOAD
+# UTIL: CSV UPLOAD / DOWNLOAD
 # =========================
+_COLS_TEXTO_CSV = ("Data", "Descrição")
+
+def ler_csv(arquivo) -> pd.DataFrame:
+    # parser do pyarrow (multi-thread). "Data" e "Descrição" são sempre texto: dtype fixo
+    # pula a inferência (e o pyarrow não vira "Data" em date). Lê como "string" porque,
+    # com dtype=str, o pyarrow grava célula vazia como o texto "None" (mudaria o tx_id);
+    # depois volta para object com NaN, igual ao parser C
+    dtype = {c: "string" for c in _COLS_TEXTO_CSV}
+    try:
+        df = pd.read_csv(arquivo, engine="pyarrow", dtype=dtype)
+    except pa.ArrowInvalid:
+        # o pyarrow recusa linha com menos campos que o header (ex.: rodapé/total do extrato);
+        # o parser C completa essas células com NaN
+        arquivo.seek(0)
+        df = pd.read_csv(arquivo, dtype=dtype)
+    df = df.astype({c: object for c in _COLS_TEXTO_CSV if c in df.columns})
+    return df.fillna(np.nan)
+
+# troca "," <-> "." numa passada só (formato en-US -> pt-BR)
+_TRANS_BRL = str.maketrans(",.", ".,")
+
+def formatar_brl(x: float) -> str:
+    # 1234.5 -> "R$ 1.234,50"
+    return f"R$ {x:,.2f}".translate(_TRANS_BRL)
+
+def formatar_brl_series(s: pd.Series) -> pd.Series:
+    # mesmo que formatar_brl, para a coluna inteira (labels dos gráficos)
+    return s.map("R$ {:,.2f}".format).str.translate(_TRANS_BRL)
+
+# o botão de download re-serializa o df a cada rerun (qualquer clique no multiselect);
+# limitado como os outros caches de extrato
+@st.cache_data(show_spinner=False, ttl=CSV_CACHE_TTL, max_entries=CSV_CACHE_MAX_ENTRIES)
 def gerar_download_csv(df: pd.DataFrame) -> bytes:
     return df.to_csv(index=False).encode("utf-8")
 
-def make_tx_id(row: pd.Series) -> str:
-    base = f"{row.get('data','')}|{row.get('valor','')}|{row.get('descricao','')}|{row.get('conta','')}|{row.get('Categoria','')}"
-    base = str(base).strip().lower()
-    return hashlib.sha1(base.encode("utf-8")).hexdigest()
+def make_tx_ids(df: pd.DataFrame) -> list:
+    # "data|valor|descricao|conta|Categoria" montado, normalizado (strip/lower) e hasheado
+    # num laço só por linha
+    cols = [df[c].astype(str).tolist() for c in ("data", "valor", "descricao", "conta", "Categoria")]
+
+    # SHA-1 mantido de propósito: os tx_id já gravados na aba db foram gerados com ele.
+    # Trocar o hash (blake2b/xxhash) faria o dedup não reconhecer linhas já salvas.
+    sha1 = hashlib.sha1
+    return [sha1("|".join(t).strip().lower().encode("utf-8")).hexdigest() for t in zip(*cols)]
+
+def hash_df(df: pd.DataFrame) -> str:
+    # hash do conteúdo (colunas + valores), usado como chave de cache
+    h = hashlib.blake2b(digest_size=16)
+    h.update("|".join(map(str, df.columns)).encode("utf-8"))
+    h.update(pd.util.hash_pandas_object(df, index=False).values.tobytes())
+    return h.hexdigest()
+
+# =========================
+# CLASSIFICAÇÃO (cache)
+# =========================
+@st.cache_resource  # regex compiladas 1x por config (o "_" evita o streamlit hashear o df)
+def compile_config_cached(config_hash: str, _df_config: pd.DataFrame):
+    return compile_config(_df_config)
+
+# reruns com o mesmo arquivo não re-parseiam o CSV
+@st.cache_data(show_spinner=False, ttl=CSV_CACHE_TTL, max_entries=CSV_CACHE_MAX_ENTRIES)
+def ler_e_padronizar_csv(csv_bytes: bytes) -> pd.DataFrame:
+    return padronizar_csv(ler_csv(io.BytesIO(csv_bytes)))
+
+# chave: bytes do arquivo + hash da config
+@st.cache_data(show_spinner=False, ttl=CSV_CACHE_TTL, max_entries=CSV_CACHE_MAX_ENTRIES)
+def classificar_csv_cached(csv_bytes: bytes, config_hash: str, _df_config: pd.DataFrame) -> pd.DataFrame:
+    return process_and_classify(
+        df_raw=ler_e_padronizar_csv(csv_bytes),
+        df_config=_df_config,
+        description_col="descricao",
+        compiled=compile_config_cached(config_hash, _df_config),
+    )
 
 # =========================
 # GOOGLE SHEETS
 # =========================
+@st.cache_resource  # autoriza 1x por processo (evita refazer o OAuth a cada chamada)
 def _get_gspread_client():
     scopes = [
         "https://www.googleapis.com/auth/spreadsheets",
@@ -59,10 +135,48 @@ def _get_gspread_client():
     return gspread.authorize(creds)
 
 
+@st.cache_resource  # evita o GET de metadados do open_by_key a cada leitura/escrita
+def _open_sheet(sheet_id: str):
+    return _get_gspread_client().open_by_key(sheet_id)
+
+
+@st.cache_resource(ttl=HEADER_CACHE_TTL)  # sh.worksheet() também faz um GET de metadados
+def _open_worksheet(sheet_id: str, tab_name: str):
+    return _open_sheet(sheet_id).worksheet(tab_name)
+
+
+def _header_cache_key(sheet_id: str, tab_name: str) -> str:
+    return f"gsheet_header::{sheet_id}::{tab_name}"
+
+
+def _set_header_cache(sheet_id: str, tab_name: str, header: list):
+    st.session_state[_header_cache_key(sheet_id, tab_name)] = {"header": header, "ts": time.monotonic()}
+
+
+def _drop_header_cache(sheet_id: str, tab_name: str):
+    # próxima gravação relê o header do Sheets (colunas podem ter sido movidas/inseridas)
+    st.session_state.pop(_header_cache_key(sheet_id, tab_name), None)
+
+
+def _df_to_rows(df: pd.DataFrame) -> list:
+    # linhas como list[list[str]] convertendo coluna a coluna,
+    # sem materializar um DataFrame inteiro de str (df.astype(str))
+    cols = [df.iloc[:, i].astype(str).tolist() for i in range(df.shape[1])]
+    return [list(r) for r in zip(*cols)]
+
+
+def _gsheet_write_all(ws, df: pd.DataFrame):
+    """
+    Limpa a aba e grava header + linhas numa única chamada (A1).
+    USER_ENTERED continua: valor/data precisam virar número/data na planilha.
+    """
+    ws.clear()
+    values = [list(df.columns)] + _df_to_rows(df)
+    ws.update(values, "A1", value_input_option="USER_ENTERED")
+
+
 def gsheet_read_df(sheet_id: str, tab_name: str) -> pd.DataFrame:
-    client = _get_gspread_client()
-    sh = client.open_by_key(sheet_id)
-    ws = sh.worksheet(tab_name)
+    ws = _open_worksheet(sheet_id, tab_name)
     values = ws.get_all_values()
     if not values or len(values) < 2:
         return pd.DataFrame()
@@ -79,46 +193,50 @@ def gsheet_append_dedup(sheet_id: str, tab_name: str, df_new: pd.DataFrame, id_c
     if df_new is None or df_new.empty:
         return {"acao": "nada", "novas": 0, "duplicadas": 0}
 
-    client = _get_gspread_client()
-    sh = client.open_by_key(sheet_id)
-    ws = sh.worksheet(tab_name)
+    ws = _open_worksheet(sheet_id, tab_name)
 
-    current = ws.get_all_values()
+    # Header guardado na sessão (TTL curto) -> salvamentos seguidos pulam essa leitura
+    cached = st.session_state.get(_header_cache_key(sheet_id, tab_name))
+    if cached and time.monotonic() - cached["ts"] < HEADER_CACHE_TTL:
+        header = cached["header"]
+    else:
+        # Só o header (linha 1), em vez de puxar a aba inteira
+        header = ws.row_values(1)
 
     # Aba vazia -> overwrite
-    if not current:
-        ws.clear()
-        ws.append_row(list(df_new.columns), value_input_option="USER_ENTERED")
-        ws.append_rows(df_new.astype(str).values.tolist(), value_input_option="USER_ENTERED")
+    if not header:
+        _gsheet_write_all(ws, df_new)
+        _set_header_cache(sheet_id, tab_name, [str(c).strip() for c in df_new.columns])
         return {"acao": "overwrite_vazio", "novas": len(df_new), "duplicadas": 0}
 
-    header = current[0] if len(current) > 0 else []
-    header_ok = header and any(str(h).strip() for h in header)
+    header_ok = any(str(h).strip() for h in header)
 
     if not header_ok:
-        ws.clear()
-        ws.append_row(list(df_new.columns), value_input_option="USER_ENTERED")
-        ws.append_rows(df_new.astype(str).values.tolist(), value_input_option="USER_ENTERED")
+        _gsheet_write_all(ws, df_new)
+        _set_header_cache(sheet_id, tab_name, [str(c).strip() for c in df_new.columns])
         return {"acao": "overwrite_header_invalido", "novas": len(df_new), "duplicadas": 0}
 
     header = [str(h).strip() for h in header]
 
     if id_col not in header:
+        _drop_header_cache(sheet_id, tab_name)
         raise ValueError(f"A aba '{tab_name}' não tem a coluna '{id_col}'. Crie essa coluna no header do db.")
 
+    _set_header_cache(sheet_id, tab_name, header)
+
     # Lê somente a coluna tx_id do Sheets (evita puxar tudo)
-    # current inclui header, então ids começam em current[1:]
+    # col_values inclui o header, então ids começam em [1:]
     id_index = header.index(id_col)
     ids_existentes = set()
-    for r in current[1:]:
-        if len(r) > id_index:
-            v = str(r[id_index]).strip()
-            if v:
-                ids_existentes.add(v)
+    for v in ws.col_values(id_index + 1)[1:]:
+        v = str(v).strip()
+        if v:
+            ids_existentes.add(v)
 
-    # Filtra novas
-    mask_novas = ~df_new[id_col].astype(str).isin(ids_existentes)
-    df_to_append = df_new[mask_novas].copy()
+    # Filtra novas (membership direto no set, sem passar pelo isin do pandas)
+    ids_arr = df_new[id_col].to_numpy(dtype=object)
+    mask_novas = np.fromiter((s not in ids_existentes for s in ids_arr), dtype=bool, count=len(ids_arr))
+    df_to_append = df_new[mask_novas]
 
     duplicadas = len(df_new) - len(df_to_append)
 
@@ -128,49 +246,37 @@ def gsheet_append_dedup(sheet_id: str, tab_name: str, df_new: pd.DataFrame, id_c
     # Reordena pelo header do Sheets
     missing = [c for c in header if c not in df_to_append.columns]
     if missing:
+        _drop_header_cache(sheet_id, tab_name)
         raise ValueError(f"A aba '{tab_name}' exige colunas que não existem no df_result: {missing}")
 
-    ws.append_rows(df_to_append[header].astype(str).values.tolist(), value_input_option="USER_ENTERED")
+    try:
+        ws.append_rows(_df_to_rows(df_to_append[header]), value_input_option="USER_ENTERED")
+    except Exception:
+        # header em cache pode estar velho (aba mudou): não reaproveita na próxima tentativa
+        _drop_header_cache(sheet_id, tab_name)
+        raise
     return {"acao": "append", "novas": len(df_to_append), "duplicadas": duplicadas}
 
 
 
 def gsheet_overwrite_df(sheet_id: str, tab_name: str, df: pd.DataFrame):
-    client = _get_gspread_client()
-    sh = client.open_by_key(sheet_id)
-    ws = sh.worksheet(tab_name)
-    ws.clear()
+    ws = _open_worksheet(sheet_id, tab_name)
+    _drop_header_cache(sheet_id, tab_name)  # header pode mudar
     if df.empty:
+        ws.clear()
         return
-    ws.append_row(list(df.columns), value_input_option="USER_ENTERED")
-    ws.append_rows(df.astype(str).values.tolist(), value_input_option="USER_ENTERED")
+    _gsheet_write_all(ws, df)
 
-@st.cache_data(ttl=60)  # 60s: evita ler do Sheets toda hora
+@st.cache_data(ttl=300)  # 5 min: a config quase não muda e todo salvar aqui já limpa o cache
 def gsheet_read_df_cached(sheet_id: str, tab_name: str) -> pd.DataFrame:
     return gsheet_read_df(sheet_id, tab_name)
 
-def load_config_from_sheets():
-    if not GOOGLE_SHEET_ID:
-        st.warning("Falta configurar GOOGLE_SHEET_ID nos secrets.")
-        return
-
-    df_g = gsheet_read_df_cached(GOOGLE_SHEET_ID, CONFIG_SHEET_TAB)
-
-    if df_g.empty:
-        st.warning("Aba config está vazia no Google Sheets.")
-        return
-
-    # coerção básica
-    if "prioridade" in df_g.columns:
-        df_g["prioridade"] = pd.to_numeric(df_g["prioridade"], errors="coerce").fillna(100).astype(int)
-    if "ativo" in df_g.columns:
-        df_g["ativo"] = df_g["ativo"].astype(str).str.lower().isin(["true", "1", "sim", "yes"])
-
-    st.session_state.df_config = df_g
-    
 # =========================
 # PADRONIZAÇÃO DO CSV (NUBANK)
 # =========================
+# ponto seguido (em algum lugar) de vírgula = separador de milhar pt-BR
+_RE_PONTO_MILHAR = re.compile(r"\.(?=.*,)")
+
 def padronizar_csv(df_raw: pd.DataFrame) -> pd.DataFrame:
     """
     Ajuste aqui se você usar outra origem além do Nubank.
@@ -189,12 +295,14 @@ def padronizar_csv(df_raw: pd.DataFrame) -> pd.DataFrame:
     if "conta" not in df.columns:
         df["conta"] = "Nubank"
 
-    # Normaliza valor (se vier com vírgula decimal)
-    if "valor" in df.columns:
+    # Normaliza valor (se vier com vírgula decimal). Se o parser já leu como número
+    # (export padrão do Nubank: "-45.90"), não há texto para tratar
+    if "valor" in df.columns and df["valor"].dtype.kind not in "iuf":
         s = df["valor"].astype(str).str.strip()
 
         # tenta tratar casos comuns pt-BR: "1.234,56"
-        s = s.str.replace(".", ",", regex=False).str.replace(",", ".", regex=False)
+        # remove só os pontos de milhar (os que vêm antes de uma vírgula) e troca a vírgula decimal
+        s = s.str.replace(_RE_PONTO_MILHAR, "", regex=True).str.replace(",", ".", regex=False)
         df["valor"] = pd.to_numeric(s, errors="coerce")
 
     return df
@@ -222,6 +330,7 @@ def load_config_from_sheets(force: bool = False):
 
     if force:
         gsheet_read_df_cached.clear()  # força puxar de novo
+        _drop_header_cache(GOOGLE_SHEET_ID, DB_SHEET_TAB)
 
     df_g = gsheet_read_df_cached(GOOGLE_SHEET_ID, CONFIG_SHEET_TAB)
 
@@ -274,15 +383,17 @@ with st.sidebar:
     st.caption("Se ativar, lê/escreve DB e CONFIG no Google Sheets.")
     with st.sidebar:
         if use_gsheets and st.button("🔎 Testar conexão Google Sheets"):
+            # ação explícita do usuário: o próximo salvamento relê o header do db
+            _drop_header_cache(GOOGLE_SHEET_ID, DB_SHEET_TAB)
             try:
-                client = _get_gspread_client()
+                _get_gspread_client()
                 st.success("✅ Credenciais OK")
                 if not GOOGLE_SHEET_ID:
                     st.error("Falta configurar GOOGLE_SHEET_ID nos secrets.")
                     st.stop()
                 st.success("✅ GOOGLE Panilha ID encontrado")
 
-                sh = client.open_by_key(GOOGLE_SHEET_ID)
+                sh = _open_sheet(GOOGLE_SHEET_ID)
                 st.success(f"✅ Planilha aberta: {sh.title}")
 
                 tabs = [ws.title for ws in sh.worksheets()]
@@ -327,8 +438,8 @@ with tab_upload:
     uploaded = st.file_uploader(label="Envie seu extrato bancário em CSV.", type=["csv"], )
 
     if uploaded is not None:
-        df_raw = pd.read_csv(uploaded)
-        df_raw = padronizar_csv(df_raw)
+        csv_bytes = uploaded.getvalue()
+        df_raw = ler_e_padronizar_csv(csv_bytes)
 
         st.markdown("### Prévia do CSV (padronizado)")
         st.dataframe(df_raw.head(30), use_container_width=True)
@@ -339,11 +450,7 @@ with tab_upload:
             df_config = st.session_state.df_config.copy()
 
             # 1) Classifica
-            df_result = process_and_classify(
-                df_raw=df_raw,
-                df_config=df_config,
-                description_col="descricao",
-            )
+            df_result = classificar_csv_cached(csv_bytes, hash_df(df_config), df_config)
             st.session_state.df_result = df_result
             st.success("✅ Classificação concluída.")
 
@@ -354,7 +461,7 @@ with tab_upload:
                 else:
                     try:
                         df_save = df_result[['data','valor','descricao','Categoria','conta']].copy()
-                        df_save["tx_id"] = df_save.apply(make_tx_id, axis=1)
+                        df_save["tx_id"] = make_tx_ids(df_save)
 
                         resultado = gsheet_append_dedup(
                             GOOGLE_SHEET_ID, DB_SHEET_TAB, df_save, id_col="tx_id"
@@ -382,7 +489,8 @@ with tab_upload:
 # -------------------------
 # TAB: CONFIG
 # -------------------------
-with tab_config:
+@st.fragment  # editar regras reroda só este bloco (não a página inteira)
+def render_config(use_gsheets: bool):
     st.subheader("Configurações (regras de classificação)")
 
     st.info(
@@ -431,31 +539,46 @@ with tab_config:
         if st.button("↩️ Descartar alterações"):
             st.session_state.df_config_draft = st.session_state.df_config.copy()
             st.info("Alterações descartadas (voltou para a config ativa).")
+
+
+with tab_config:
+    render_config(use_gsheets)
+
 # -------------------------
 # TAB: VISUALIZAÇÃO
 # -------------------------
-with tab_visualizacao:
+@st.fragment  # mexer no filtro reroda só os cards/gráficos
+def render_visualizacao():
     st.subheader("Resultados")
 
-    df = st.session_state.df_result.copy()
+    df = st.session_state.df_result  # só leitura: sem cópia
 
     if df.empty:
         st.warning("Ainda não há resultados. Vá na aba Upload e classifique um CSV.")
     else:
         valor_col = "valor" if "valor" in df.columns else None
 
+        # Totais (vetorizado, calculado 1x para os dois cards)
+        if valor_col:
+            vals = pd.to_numeric(df[valor_col], errors="coerce").fillna(0)
+            arr = vals.to_numpy()
+            neg = arr < 0  # uma máscara só para os dois totais
+            total_gasto = arr[neg].sum()
+            total_receita = arr[~neg].sum()
+
         # Cards
         c1, c2, c3, c4 = st.columns(4)
         with c1:
             if valor_col:
-                total = pd.to_numeric(sum([value if value <0 else 0 for value in df[valor_col] ]), errors="coerce")
-                st.metric("Total gasto", f"R$ {total:,.2f}".replace(",", "X").replace(".", ",").replace("X", "."))
+                st.metric("Total gasto", formatar_brl(total_gasto))
             else:
                 st.metric("Total gasto", "— (ajuste coluna)")
 
         with c2:
-            total = pd.to_numeric(sum([value if value >0 else 0 for value in df[valor_col] ]), errors="coerce")
-            st.metric("Total receita", f"R$ {total:,.2f}".replace(",", "X").replace(".", ",").replace("X", "."))
+            if valor_col:
+                st.metric("Total receita", formatar_brl(total_receita))
+            else:
+                st.metric("Total receita", "— (ajuste coluna)")
 
         with c3:
             cat_unique = df["Categoria"].nunique() if "Categoria" in df.columns else 0
@@ -485,8 +608,6 @@ with tab_visualizacao:
         # FILTRO DE CATEGORIAS
         # =========================
         if "Categoria" in df.columns and valor_col:
-            df[valor_col] = pd.to_numeric(df[valor_col], errors="coerce").fillna(0)
-
             categorias = sorted(df["Categoria"].dropna().unique().tolist())
 
             # >>> padrão: todas EXCETO "Não classificado"
@@ -502,13 +623,16 @@ with tab_visualizacao:
             if not categorias_selecionadas:
                 st.warning("Selecione ao menos uma categoria para exibir os gráficos.")
             else:
-                df_plot = df[df["Categoria"].isin(categorias_selecionadas)].copy()
+                mask = df["Categoria"].isin(categorias_selecionadas)
 
                 # =========================
                 # AGREGAÇÃO
                 # =========================
-                agg = df_plot.groupby("Categoria", as_index=False)[valor_col].sum()
-                total = agg[valor_col].sum() if agg[valor_col].sum() != 0 else 1
+                # usa os valores já convertidos (vals), sem copiar/alterar o df
+                agg = vals[mask].groupby(df["Categoria"][mask], observed=True).sum().reset_index()
+                total = agg[valor_col].sum()
+                if total == 0:
+                    total = 1
                 agg["percentual"] = (agg[valor_col] / total) * 100
                 agg = agg.sort_values(valor_col, ascending=False)
 
@@ -520,9 +644,7 @@ with tab_visualizacao:
                 with colL:
                     st.markdown("### Total por categoria (R$)")
 
-                    agg["label_valor"] = agg[valor_col].map(
-                        lambda x: f"R$ {x:,.2f}".replace(",", "X").replace(".", ",").replace("X", ".")
-                    )
+                    agg["label_valor"] = formatar_brl_series(agg[valor_col])
 
                     fig1 = px.bar(
                         agg,
@@ -567,4 +689,9 @@ with tab_visualizacao:
         else:
             st.info("Para o gráfico, garanta que existam as colunas **Categoria** e **valor**.")
 
+
+with tab_visualizacao:
+    render_visualizacao()
+
+
 st.caption("Dica: no Google Sheets, mantenha a aba 'db' com cabeçalho fixo e colunas estáveis, para o metódo de inserir dados não virar bagunça.")
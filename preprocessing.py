@@ -3,13 +3,15 @@ from __future__ import annotations
 
 import re
 from dataclasses import dataclass
-from typing import List, Optional, Tuple
+from functools import lru_cache
+from typing import AbstractSet, Dict, List, Optional, Tuple
 
+import numpy as np
 import pandas as pd
 from unidecode import unidecode
 
 
-DEFAULT_STOPWORDS = {
+DEFAULT_STOPWORDS = frozenset({
     "de", "da", "do", "das", "dos", "para", "por", "em", "no", "na",
     "e", "a", "o", "as", "os", "um", "uma", "ao",
 
@@ -17,48 +19,88 @@ DEFAULT_STOPWORDS = {
     "pix", "transferencia", "ted", "doc", "br", "ltda", "mei", "me",
     "servico", "servicos", "assinatura", "mensalidade",
     "estabelecimento", "loj", "loja",
-}
+})
 
 TOKEN_MIN_LEN = 2
 MERCHANT_KEY_MAX_TOKENS = 4
 
+# pontuação, dígitos e qualquer outro ASCII que não seja a-z/espaço -> " " (um str.translate só)
+_TRANS_NAO_ALFA = str.maketrans({c: " " for c in map(chr, range(128)) if not ("a" <= c <= "z" or c.isspace())})
+
+# acentos do Latin-1/Latin Extended-A (á, ç, õ, ...) -> ASCII num str.translate (laço em C);
+# a tabela vem do próprio unidecode, então o resultado é o mesmo. Fora dessa faixa cai no unidecode
+_FOLD = str.maketrans({c: unidecode(c) for c in map(chr, range(0x80, 0x180))})
+
+# pattern vazio na config: regra que nunca casa (compilada 1x)
+_NEVER_MATCH = re.compile(r"a^")
+
 
 def normalize_text(text: str) -> str:
     if text is None:
         return ""
 
     s = str(text).strip().lower()
-    s = unidecode(s)
-    s = re.sub(r"[*_\-\/\\|:;.,(){}\[\]<>]+", " ", s)
-    s = re.sub(r"\d+", " ", s)
-    s = re.sub(r"[^a-z\s]+", " ", s)
-    s = re.sub(r"\s+", " ", s).strip()
+    if not s.isascii():
+        s = s.translate(_FOLD)
+        if not s.isascii():
+            s = unidecode(s)
+    s = s.translate(_TRANS_NAO_ALFA)
+    # split() sem argumento já junta qualquer sequência de espaços e apara as pontas
+    s = " ".join(s.split())
     return s
 
 
-def tokenize(text: str, stopwords: Optional[set] = None) -> List[str]:
+def normalize_batch(values: List[str]) -> List[str]:
+    # extrato repete muito a mesma descrição: cada texto distinto é normalizado uma vez só
+    cache: Dict[str, str] = {}
+    out = []
+    for v in values:
+        n = cache.get(v)
+        if n is None:
+            n = cache[v] = normalize_text(v)
+        out.append(n)
+    return out
+
+
+def normalize_series(s: pd.Series) -> pd.Series:
+    return pd.Series(normalize_batch(s.astype(str).tolist()), index=s.index, dtype=object)
+
+
+def tokenize(text: str, stopwords: Optional[AbstractSet[str]] = None) -> List[str]:
+    return _tokens_from_normalized(normalize_text(text), stopwords)
+
+
+def _tokens_from_normalized(s: str, stopwords: Optional[AbstractSet[str]] = None) -> List[str]:
     if stopwords is None:
         stopwords = DEFAULT_STOPWORDS
 
-    s = normalize_text(text)
     if not s:
         return []
 
-    tokens = []
-    for t in s.split():
-        if len(t) < TOKEN_MIN_LEN:
-            continue
-        if t in stopwords:
-            continue
-        tokens.append(t)
-    return tokens
+    min_len = TOKEN_MIN_LEN
+    return [t for t in s.split() if len(t) >= min_len and t not in stopwords]
 
 
 def build_merchant_key(description: str, max_tokens: int = MERCHANT_KEY_MAX_TOKENS) -> str:
-    toks = tokenize(description)
-    if not toks:
-        return ""
-    return " ".join(toks[:max_tokens])
+    return merchant_key_from_normalized(normalize_text(description), max_tokens)
+
+
+def merchant_key_from_normalized(normalized: str, max_tokens: int = MERCHANT_KEY_MAX_TOKENS) -> str:
+    # mesmo que build_merchant_key, mas para texto que já passou por normalize_text
+    if max_tokens <= 0:
+        return " ".join(_tokens_from_normalized(normalized)[:max_tokens])
+
+    # para assim que junta max_tokens (não filtra a descrição inteira à toa)
+    stopwords = DEFAULT_STOPWORDS
+    min_len = TOKEN_MIN_LEN
+    toks = []
+    for t in normalized.split():
+        if len(t) < min_len or t in stopwords:
+            continue
+        toks.append(t)
+        if len(toks) == max_tokens:
+            break
+    return " ".join(toks)
 
 
 @dataclass
@@ -71,22 +113,37 @@ class Rule:
     ativo: bool
 
 
+@dataclass
+class CompiledRules:
+    active: List[Rule]                    # só as ativas, ordenadas por (prioridade, -len); índices abaixo apontam aqui
+    literals: Dict[str, int]              # literal pura -> índice da regra
+    literal_max_tokens: int               # nº de tokens da maior literal (limita os n-gramas testados)
+    regex_rules: List[Tuple[int, Rule]]   # o resto: (índice, regra)
+    union: Optional[re.Pattern]           # regex única das regex_rules (None -> loop)
+
+
+# re.Pattern é imutável: a mesma pattern_raw reaproveita o objeto entre configs/reruns
+@lru_cache(maxsize=4096)
 def _compile_rule(pattern_raw: str) -> re.Pattern:
     p = (pattern_raw or "").strip()
     if not p:
-        return re.compile(r"a^")
+        return _NEVER_MATCH
 
     if p.lower().startswith("re:"):
         regex = p[3:].strip()
         return re.compile(regex, flags=re.IGNORECASE)
 
     lit = re.escape(p.lower())
-    return re.compile(rf"(^|\s){lit}(\s|$)", flags=re.IGNORECASE)
+    # grupos não-capturantes: o engine não precisa salvar marcas (pesa na regex unida).
+    # literal ASCII já está em minúsculas, como o merchant_key: IGNORECASE só custa
+    # (fora do ASCII o casefold do re pode casar mais que o lower(), então mantém)
+    flags = 0 if lit.isascii() else re.IGNORECASE
+    return re.compile(rf"(?:^|\s){lit}(?:\s|$)", flags=flags)
 
 
-def compile_config(df_config: pd.DataFrame) -> List[Rule]:
+def compile_config(df_config: pd.DataFrame) -> CompiledRules:
     if df_config is None or df_config.empty:
-        return []
+        return _compile_rules([])
 
     df = df_config.copy()
     for col in ["pattern", "categoria", "subcategoria"]:
@@ -98,75 +155,192 @@ def compile_config(df_config: pd.DataFrame) -> List[Rule]:
     if "ativo" not in df.columns:
         df["ativo"] = True
 
-    rules: List[Rule] = []
-    for _, row in df.iterrows():
-        ativo = str(row.get("ativo", True)).strip().lower() not in {"false", "0", "nao", "não"}
-        prio = pd.to_numeric(row.get("prioridade", 100), errors="coerce")
-        # prio = 100 if pd.isna(prio_raw) else int(prio_raw)
-        if pd.isna(prio):
-            prio = 100
-
-        pat_raw = str(row.get("pattern", "")).strip()
-        categoria = str(row.get("categoria", "")).strip()
-        subcategoria = str(row.get("subcategoria", "")).strip()
-
-        rules.append(
-            Rule(
-                pattern_raw=pat_raw,
-                pattern=_compile_rule(pat_raw),
-                categoria=categoria,
-                subcategoria=subcategoria,
-                prioridade=int(prio),
-                ativo=ativo,
-            )
+    # coerção por coluna inteira; os Rule saem do zip das colunas
+    pats = df["pattern"].astype(str).str.strip().tolist()
+    cats = df["categoria"].astype(str).str.strip().tolist()
+    subs = df["subcategoria"].astype(str).str.strip().tolist()
+    prios = pd.to_numeric(df["prioridade"], errors="coerce").fillna(100).astype(int).tolist()
+    ativos = (~df["ativo"].astype(str).str.strip().str.lower().isin({"false", "0", "nao", "não"})).tolist()
+
+    rules: List[Rule] = [
+        Rule(
+            pattern_raw=pat_raw,
+            pattern=_compile_rule(pat_raw),
+            categoria=categoria,
+            subcategoria=subcategoria,
+            prioridade=prio,
+            ativo=ativo,
         )
+        for pat_raw, categoria, subcategoria, prio, ativo in zip(pats, cats, subs, prios, ativos)
+    ]
 
     rules.sort(key=lambda r: (r.prioridade, -len(r.pattern_raw)))
-    return rules
+    return _compile_rules(rules)
+
+
+# pattern literal "puro": só letras e espaços simples, o mesmo alfabeto do merchant_key normalizado
+_RE_LITERAL_KEY = re.compile(r"[a-z]+(?: [a-z]+)*")
+
+# backreference / condicional por número de grupo: quebram quando a regra entra na união
+_RE_GROUP_REF = re.compile(r"\\[1-9]|\(\?P=|\(\?\(")
+
+
+def _split_literal_rules(rules: List[Rule]) -> Tuple[Dict[str, int], List[Tuple[int, Rule]]]:
+    """
+    Separa as regras (já ordenadas) em:
+      - literais puras -> dict texto -> índice da primeira regra (a de maior prioridade)
+      - o resto (re: ou literais com acento/dígito/pontuação) -> lista (índice, regra)
+    Uma literal pura casa (cercada por início/fim ou espaço) exatamente quando é uma
+    sequência contígua de tokens do merchant_key, então basta um lookup no dict.
+    """
+    literals: Dict[str, int] = {}
+    regex_rules: List[Tuple[int, Rule]] = []
+
+    for i, rule in enumerate(rules):
+        p = (rule.pattern_raw or "").strip().lower()
+        if not p.startswith("re:") and _RE_LITERAL_KEY.fullmatch(p):
+            literals.setdefault(p, i)
+        else:
+            regex_rules.append((i, rule))
+
+    return literals, regex_rules
+
+
+def _build_union(regex_rules: List[Tuple[int, Rule]]) -> Optional[re.Pattern]:
+    """
+    Junta as regras (já ordenadas) numa única regex: ^(?:.*?(?P<r0>...)|.*?(?P<r1>...)|...).
+    O .*? em cada alternativa faz a primeira regra que casar em qualquer posição vencer,
+    igual ao loop regra a regra. Retorna None se não der para unir (cai no loop).
+    """
+    if not regex_rules:
+        return None
+
+    parts = []
+    for i, rule in regex_rules:
+        src = rule.pattern.pattern
+        if _RE_GROUP_REF.search(src):
+            return None
+        # IGNORECASE só onde a regra tem (re:), no escopo dela
+        if rule.pattern.flags & re.IGNORECASE:
+            src = f"(?i:{src})"
+        parts.append(f"(?s:.*?)(?P<r{i}>{src})")
+
+    try:
+        return re.compile("^(?:" + "|".join(parts) + ")")
+    except re.error:
+        # ex.: flags globais no meio do pattern, grupos nomeados repetidos
+        return None
+
+
+def _match_literal(mk: str, literals: Dict[str, int], max_tokens: int) -> int:
+    # testa as sequências contíguas de tokens (merchant_key tem poucos tokens),
+    # só até o tamanho da maior literal: n-grama maior nunca está no dict
+    toks = mk.split(" ")
+    n = len(toks)
+    best = -1
+    for i in range(n):
+        for j in range(i + 1, min(i + max_tokens, n) + 1):
+            idx = literals.get(" ".join(toks[i:j]))
+            if idx is not None and (best < 0 or idx < best):
+                best = idx
+    return best
+
+
+def _compile_rules(rules: List[Rule]) -> CompiledRules:
+    # monta (1x por config) o lookup de literais e a regex única do resto
+    active = [r for r in rules if r.ativo]
+    literals, regex_rules = _split_literal_rules(active)
+    return CompiledRules(
+        active=active,
+        literals=literals,
+        literal_max_tokens=max((k.count(" ") + 1 for k in literals), default=0),
+        regex_rules=regex_rules,
+        union=_build_union(regex_rules),
+    )
+
+
+def _match_rule_index(mk: str, compiled: CompiledRules) -> int:
+    """Índice (em compiled.active) da primeira regra que casa com mk, ou -1."""
+    literals = compiled.literals
+    union = compiled.union
+    best = _match_literal(mk, literals, compiled.literal_max_tokens) if literals else -1
+
+    # a literal achada já vem antes de qualquer regra regex -> nem roda a regex
+    regex_rules = compiled.regex_rules
+    if best >= 0 and (not regex_rules or regex_rules[0][0] > best):
+        return best
+
+    if union is not None:
+        m = union.match(mk)
+        if m is not None:
+            idx = int(m.lastgroup[1:])
+            if best < 0 or idx < best:
+                best = idx
+        return best
+
+    for idx, rule in regex_rules:
+        if best >= 0 and idx > best:
+            break
+        if rule.pattern.search(mk):
+            return idx
+    return best
 
 
-def classify_merchant_key(merchant_key: str, rules: List[Rule]) -> Tuple[str, str, str]:
+def classify_merchant_key(merchant_key: str, compiled: CompiledRules) -> Tuple[str, str, str]:
+    # aceita texto cru: normaliza aqui (process_and_classify já passa a chave normalizada)
     mk = normalize_text(merchant_key)
-    if not mk:
+    idx = _match_rule_index(mk, compiled) if mk else -1
+    if idx < 0:
         return ("Não classificado", "", "nao_classificado")
 
-    for rule in rules:
-        if not rule.ativo:
-            continue
-        if rule.pattern.search(mk):
-            return (rule.categoria, rule.subcategoria, "regex_config")
-
-    return ("Não classificado", "", "nao_classificado")
+    rule = compiled.active[idx]
+    return (rule.categoria, rule.subcategoria, "regex_config")
 
 
 def process_and_classify(
     df_raw: pd.DataFrame,
     df_config: pd.DataFrame,
     description_col: str = "descricao",
+    compiled: Optional[CompiledRules] = None,
 ) -> pd.DataFrame:
     df = df_raw.copy()
 
     if description_col not in df.columns:
         raise ValueError(f"CSV precisa ter a coluna '{description_col}' (ajuste no app.py)")
 
-    rules = compile_config(df_config)
-
-    df["descricao_normalizada"] = df[description_col].astype(str).map(normalize_text)
-    df["merchant_key"] = df[description_col].astype(str).map(build_merchant_key)
-
-    cats = []
-    subcats = []
-    methods = []
-
-    for mk in df["merchant_key"].astype(str).tolist():
-        c, s, m = classify_merchant_key(mk, rules)
-        cats.append(c)
-        subcats.append(s)
-        methods.append(m)
-
-    df["Categoria"] = cats
-    df["Subcategoria"] = subcats
-    df["MetodoClassificacao"] = methods
+    # regras pré-compiladas (ex.: cache do app) evitam recompilar a mesma config
+    if compiled is None:
+        compiled = compile_config(df_config)
+
+    # normaliza 1x e reaproveita para o merchant_key
+    df["descricao_normalizada"] = normalize_series(df[description_col])
+    df["merchant_key"] = df["descricao_normalizada"].map(merchant_key_from_normalized)
+
+    # índice da regra vencedora (-1 = não classificado), calculado 1x por merchant_key distinto
+    # (extrato repete muito o mesmo estabelecimento) e espalhado para as linhas via codes
+    # merchant_key já sai normalizado de merchant_key_from_normalized: casa direto
+    codes, keys = pd.factorize(df["merchant_key"])
+    idx_keys = np.fromiter(
+        (_match_rule_index(mk, compiled) if mk else -1 for mk in keys),
+        dtype=np.intp,
+        count=len(keys),
+    )
+    idx = idx_keys[codes]
+
+    # a última posição é o "Não classificado": o índice -1 cai nela
+    active = compiled.active
+    cats = np.array([r.categoria for r in active] + ["Não classificado"], dtype=object)
+    subcats = np.array([r.subcategoria for r in active] + [""], dtype=object)
+    methods = np.array(["regex_config"] * len(active) + ["nao_classificado"], dtype=object)
+
+    df["Categoria"] = cats[idx]
+    df["Subcategoria"] = subcats[idx]
+    df["MetodoClassificacao"] = methods[idx]
+
+    # poucos valores distintos repetidos em muitas linhas: categorical (códigos int)
+    # ocupa menos e deixa groupby/isin/nunique mais leves
+    for col in ("merchant_key", "Categoria", "Subcategoria", "MetodoClassificacao"):
+        df[col] = df[col].astype("category")
 
     return df
 
@@ -0,0 +1,84 @@
+import random
+import re
+
+import pandas as pd
+
+from preprocessing import build_merchant_key, process_and_classify
+
+
+# =========================
+# REFERÊNCIA: loop regra a regra (como era antes do CompiledRules)
+# =========================
+def _compile_ref(pattern_raw: str) -> re.Pattern:
+    p = pattern_raw.strip()
+    if not p:
+        return re.compile(r"a^")
+    if p.lower().startswith("re:"):
+        return re.compile(p[3:].strip(), flags=re.IGNORECASE)
+    return re.compile(rf"(^|\s){re.escape(p.lower())}(\s|$)", flags=re.IGNORECASE)
+
+
+def _classify_ref(descricoes, config):
+    # ordena por (prioridade, -len) e a primeira regra ativa que casar vence
+    rules = sorted(config, key=lambda r: (r["prioridade"], -len(r["pattern"].strip())))
+    rules = [(_compile_ref(r["pattern"]), r) for r in rules if r["ativo"]]
+
+    out = []
+    for d in descricoes:
+        mk = build_merchant_key(d)
+        hit = next((r for pat, r in rules if mk and pat.search(mk)), None)
+        out.append((hit["categoria"], hit["subcategoria"]) if hit else ("Não classificado", ""))
+    return out
+
+
+def _classify(descricoes, config):
+    df = process_and_classify(pd.DataFrame({"descricao": descricoes}), pd.DataFrame(config))
+    return list(zip(df["Categoria"].astype(str), df["Subcategoria"].astype(str)))
+
+
+# literais (puras, com acento/dígito, maiúsculas, várias palavras) e regex com grupos,
+# backreference, grupo nomeado, flag inline, lookaround e condicional
+PATTERNS = [
+    "oficina", "pecas", "js pedras", "pedras", "minas brita", "da costa", "costa santos",
+    "lourival da costa santos", "mercado", "mercado livre", "x", "auto", "café", "Oficina",
+    "PECAS ", "s10", "", "re:ra", "re:^po", "re:o\\b", "re:(?<=s)ta", "re:[aeiou]{2}",
+    "re:mercado$", "re:\\Dx", "re:(x)\\1", "re:(?P<n>po)sto", "re:(?P<a>o)(?P=a)",
+    "re:(?i)MERC", "re:MERC", "re:P[OS]", "re:ca(?=f)", "re:(a)?(?(1)b|c)", "re:auto|center",
+]
+
+TOKENS = [
+    "Oficina", "JCJ", "Posto", "S10", "pecas", "PEÇAS", "mercado", "livre", "café", "da",
+    "costa", "santos", "lourival", "js", "pedras", "minas", "brita", "xx", "x", "po", "sto",
+    "auto", "center", "oo", "ab", "ta", "*123", "-", "compra", "pix", "ÉÇ", "MERC",
+]
+
+
+def test_ordem_das_regras():
+    config = [
+        {"pattern": "pedras", "categoria": "Curta", "subcategoria": "", "prioridade": 10, "ativo": True},
+        {"pattern": "js pedras", "categoria": "Longa", "subcategoria": "", "prioridade": 10, "ativo": True},
+        {"pattern": "re:^js", "categoria": "Regex", "subcategoria": "", "prioridade": 5, "ativo": True},
+        {"pattern": "posto", "categoria": "Inativa", "subcategoria": "", "prioridade": 1, "ativo": False},
+    ]
+    descricoes = ["JS Pedras *123", "Pedras Minas", "Posto S10", ""]
+    assert _classify(descricoes, config) == [
+        ("Regex", ""), ("Curta", ""), ("Não classificado", ""), ("Não classificado", ""),
+    ]
+    assert _classify(descricoes, config) == _classify_ref(descricoes, config)
+
+
+def test_igual_ao_loop_regra_a_regra():
+    for seed in range(300):
+        rnd = random.Random(seed)
+        config = [
+            {
+                "pattern": p,
+                "categoria": f"c{i}",
+                "subcategoria": f"s{i}",
+                "prioridade": rnd.choice([1, 5, 10, 10, 100]),
+                "ativo": rnd.random() < 0.85,
+            }
+            for i, p in enumerate(rnd.sample(PATTERNS, rnd.randint(1, 12)))
+        ]
+        descricoes = [" ".join(rnd.choices(TOKENS, k=rnd.randint(0, 6))) for _ in range(40)]
+        assert _classify(descricoes, config) == _classify_ref(descricoes, config), seed